@@ -0,0 +1,53 @@
+""" Cold-start cost of loading this app: time django.setup() in fresh
+interpreters with and without dj_bioinformatics_protein installed, and report
+the difference.
+
+    python benchmarks/import_time.py [--runs 20]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SNIPPET = """
+import time
+start = time.perf_counter()
+import django
+from django.conf import settings
+settings.configure(
+    INSTALLED_APPS=%r,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+)
+django.setup()
+print(time.perf_counter() - start)
+"""
+
+BASE_APPS = ['django.contrib.contenttypes', 'django.contrib.auth']
+
+
+def measure(installed_apps, runs):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')])))
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', SNIPPET % installed_apps], env=env)
+        timings.append(float(output.decode().strip().splitlines()[-1]) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    baseline = measure(BASE_APPS, args.runs)
+    with_app = measure(BASE_APPS + ['dj_bioinformatics_protein'], args.runs)
+    for label, timings in (('django only', baseline), ('with app', with_app)):
+        print('%-12s median %7.2f ms  min %7.2f ms' % (label, statistics.median(timings), min(timings)))
+    print('app cost     median %7.2f ms' % (statistics.median(with_app) - statistics.median(baseline)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+""" FORMATS settings, merged over the defaults below on first access rather
+than at import, and re-read whenever settings.FORMATS changes (e.g. under
+override_settings).
+
+    from dj_bioinformatics_protein.conf import conf
+    conf.MAX_SEQUENCE_LENGTH
+    conf.ALIGNMENT['PDB_CODE_LENGTH']
+"""
+import copy
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+
+DEFAULTS = {
+    "MAX_DESCRIPTION_LENGTH": 1000,
+    "MAX_SEQUENCE_LENGTH": 5000,
+    "FASTA": {},
+    "ALIGNMENT": {
+        'PDB_CODE_LENGTH': 4,
+        'PDB_CHAIN_LENGTH': 1,
+        # What to do when a deferred heavy column is loaded row by row (see
+        # Alignment.HEAVY_FIELDS): 'warn', 'raise' or None to allow silently.
+        'DEFERRED_FIELD_ACCESS': 'warn',
+    },
+    # see routers.PrimaryReplicaRouter
+    "DATABASES": {
+        'PRIMARY': DEFAULT_DB_ALIAS,
+        'REPLICAS': [],
+        'STICKY_SECONDS': 5,
+        'MIGRATE_REPLICAS': False,
+    },
+}
+
+
+class FormatsSettings(object):
+
+    def __init__(self, defaults=None):
+        self.defaults = defaults or DEFAULTS
+        self._merged = None
+
+    def _load(self):
+        user_settings = getattr(settings, 'FORMATS', {})
+        if not isinstance(user_settings, dict):
+            raise ImproperlyConfigured("settings.FORMATS must be a dict")
+        merged = copy.deepcopy(self.defaults)
+        for key, value in user_settings.items():
+            # sections are merged key by key, so overriding one ALIGNMENT
+            # option keeps the defaults for the others
+            if isinstance(merged.get(key), dict):
+                if not isinstance(value, dict):
+                    raise ImproperlyConfigured("settings.FORMATS['%s'] must be a dict" % key)
+                merged[key].update(value)
+            else:
+                merged[key] = value
+        return merged
+
+    def as_dict(self):
+        if self._merged is None:
+            self._merged = self._load()
+        return self._merged
+
+    def reload(self):
+        self._merged = None
+
+    @property
+    def MAX_FASTA_FILE_LENGTH(self):
+        """ Longest FASTA file (as a string) we accept. Defaults to the sum of
+        the description and sequence limits; override with
+
+        FORMATS = {
+            'FASTA': {
+                'MAX_FASTA_FILE_LENGTH': <integer>
+            }
+        }
+        """
+        formats = self.as_dict()
+        try:
+            return formats['FASTA']['MAX_FASTA_FILE_LENGTH']
+        except KeyError:
+            return formats['MAX_DESCRIPTION_LENGTH'] + formats['MAX_SEQUENCE_LENGTH']
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.as_dict()[name]
+        except KeyError:
+            raise AttributeError("Invalid FORMATS setting: '%s'" % name)
+
+
+conf = FormatsSettings()
+
+
+def reload_formats(setting, **kwargs):
+    if setting == 'FORMATS':
+        conf.reload()
+
+
+setting_changed.connect(reload_formats)
@@ -1,6 +1,13 @@
+import base64
+import codecs
+import lzma
+import zlib
+
+from django import forms
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
 
+from .residue_map import ResidueMap
 from .validatiors import (
     AminoAcidWithNonCanonicalAlignmentValidator,
     AminoAcidWithNonCanonicalValidator,
@@ -25,3 +32,225 @@ class AminoAcidAlignmentField(models.CharField):
 class AminoAcidAlignmentTextField(models.TextField):
     default_validators = [AminoAcidWithNonCanonicalAlignmentValidator]
     description = _("Amino acid sequence (up to %(max_length)s)")
+
+
+# Stored values are MAGIC + one codec byte + the compressed UTF-8 text. Anything
+# without the magic prefix is legacy uncompressed text and is read as-is.
+COMPRESSED_MAGIC = b'\x00DJC'
+CODEC_ZLIB = b'z'
+CODEC_LZMA = b'x'
+
+
+def _decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError("Unknown compression codec %r" % codec)
+
+
+class CompressedText(object):
+    """ Compressed value as read from the database. Decompression is left to
+    the first attribute access (see CompressedTextDescriptor) or to
+    iter_text() when streaming.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def codec(self):
+        return self.data[len(COMPRESSED_MAGIC):len(COMPRESSED_MAGIC) + 1]
+
+    @property
+    def payload(self):
+        return self.data[len(COMPRESSED_MAGIC) + 1:]
+
+    def decompress(self):
+        return ''.join(self.iter_text(chunk_size=len(self.data)))
+
+    def iter_text(self, chunk_size=64 * 1024):
+        """ Decompress chunk_size bytes of payload at a time, yielding text.
+        """
+        decompressor = _decompressor(self.codec)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        payload = self.payload
+        for i in range(0, len(payload), chunk_size):
+            text = decoder.decode(decompressor.decompress(payload[i:i + chunk_size]))
+            if text:
+                yield text
+        tail = decompressor.flush() if hasattr(decompressor, 'flush') else b''
+        text = decoder.decode(tail, final=True)
+        if text:
+            yield text
+
+
+class CompressedTextDescriptor(object):
+    """ Keeps the CompressedText in the instance __dict__ until the attribute
+    is read, then swaps in the decompressed text.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            # deferred; same as django's DeferredAttribute
+            instance.refresh_from_db(fields=[attname])
+        value = instance.__dict__[attname]
+        if isinstance(value, CompressedText):
+            value = instance.__dict__[attname] = value.decompress()
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.BinaryField):
+    """ Text stored compressed in a binary column. Reads are lazy: rows come
+    back with the compressed bytes and are decompressed the first time the
+    attribute is accessed. Unchanged values are written back without being
+    recompressed, and values compression wouldn't shrink are stored as plain
+    UTF-8. Unlike BinaryField it is editable and shows up in forms as text.
+
+    :param algorithm: 'zlib' (default) or 'lzma'
+    :param level: compression level passed to the compressor
+    """
+    description = _("Compressed text")
+
+    ALGORITHMS = {
+        'zlib': CODEC_ZLIB,
+        'lzma': CODEC_LZMA,
+    }
+
+    def __init__(self, *args, **kwargs):
+        self.algorithm = kwargs.pop('algorithm', 'zlib')
+        self.level = kwargs.pop('level', None)
+        if self.algorithm not in self.ALGORITHMS:
+            raise ValueError("Unknown compression algorithm %r" % self.algorithm)
+        # BinaryField forces (or defaults) editable=False; this holds text
+        editable = kwargs.pop('editable', True)
+        super(CompressedTextField, self).__init__(*args, **kwargs)
+        self.editable = editable
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CompressedTextField, self).deconstruct()
+        kwargs.pop('editable', None)
+        if not self.editable:
+            kwargs['editable'] = False
+        if self.algorithm != 'zlib':
+            kwargs['algorithm'] = self.algorithm
+        if self.level is not None:
+            kwargs['level'] = self.level
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.attname, CompressedTextDescriptor(self))
+
+    def compress(self, text):
+        """ Header + compressed payload, or the plain UTF-8 bytes when that
+        is no larger (short values).
+        """
+        data = text.encode('utf-8')
+        if self.algorithm == 'lzma':
+            kwargs = {'preset': self.level} if self.level is not None else {}
+            payload = lzma.compress(data, **kwargs)
+        else:
+            payload = zlib.compress(data, self.level if self.level is not None else 6)
+        compressed = COMPRESSED_MAGIC + self.ALGORITHMS[self.algorithm] + payload
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is None:
+            return value
+        if isinstance(value, str):
+            # sqlite keeps legacy TEXT values after the column type changes
+            return value
+        value = bytes(value)
+        if value.startswith(COMPRESSED_MAGIC):
+            return CompressedText(value)
+        return value.decode('utf-8')
+
+    def to_python(self, value):
+        if isinstance(value, CompressedText):
+            return value.decompress()
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.from_db_value(value, None, None)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        if isinstance(value, CompressedText):
+            return value.data
+        return self.compress(value)
+
+    def pre_save(self, model_instance, add):
+        if self.attname not in model_instance.__dict__:
+            # deferred; let the descriptor fetch it rather than saving None
+            return getattr(model_instance, self.attname)
+        # bypass the descriptor so untouched values aren't decompressed
+        return model_instance.__dict__[self.attname]
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        defaults = {
+            'form_class': forms.CharField,
+            'widget': forms.Textarea,
+        }
+        defaults.update(kwargs)
+        # skip BinaryField.formfield, which has no text form field
+        return models.Field.formfield(self, **defaults)
+
+    def iter_text(self, instance, chunk_size=64 * 1024):
+        """ Stream the instance's value without holding the whole decompressed
+        text in memory (if it hasn't been accessed already).
+        """
+        if self.attname not in instance.__dict__:
+            instance.refresh_from_db(fields=[self.attname])
+        value = instance.__dict__[self.attname]
+        if isinstance(value, CompressedText):
+            for text in value.iter_text(chunk_size):
+                yield text
+        elif value:
+            for i in range(0, len(value), chunk_size):
+                yield value[i:i + chunk_size]
+
+
+class ResidueMapField(models.BinaryField):
+    """ Stores a ResidueMap as packed little-endian int32 arrays. The map is
+    derived data: Alignment.save() rebuilds it, QuerySet.update() on the
+    aligned sequences or offsets does not, so follow such updates with
+    build_residue_maps().
+    """
+    description = _("Residue number mapping")
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is None:
+            return value
+        return ResidueMap.from_bytes(bytes(value))
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            # serialized with value_to_string
+            value = base64.b64decode(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return ResidueMap.from_bytes(bytes(value))
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return value.to_bytes()
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        return None if value is None else base64.b64encode(value.to_bytes()).decode('ascii')
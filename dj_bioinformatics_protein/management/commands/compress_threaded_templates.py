@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from dj_bioinformatics_protein.fields import COMPRESSED_MAGIC, CompressedText
+from dj_bioinformatics_protein.models import Alignment
+from dj_bioinformatics_protein.routers import get_primary_alias
+
+
+class Command(BaseCommand):
+    help = "Compress Alignment.threaded_template values still stored as plain text."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Rows to read and rewrite per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how much would be saved.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        field = Alignment._meta.get_field('threaded_template')
+        # read from the database we write to, not a (possibly lagging) replica
+        write_db = get_primary_alias()
+
+        last_pk = 0
+        converted = skipped = incompressible = 0
+        raw_bytes = compressed_bytes = 0
+        while True:
+            batch = list(Alignment.objects.using(write_db)
+                         .filter(pk__gt=last_pk)
+                         .exclude(threaded_template=None)
+                         .order_by('pk')
+                         .only('pk', 'threaded_template')[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic(using=write_db):
+                for alignment in batch:
+                    value = alignment.__dict__['threaded_template']
+                    if isinstance(value, CompressedText):
+                        skipped += 1
+                        continue
+                    data = field.compress(value)
+                    if not data.startswith(COMPRESSED_MAGIC):
+                        # too short to gain anything; already stored as plain text
+                        incompressible += 1
+                        continue
+                    raw_bytes += len(value.encode('utf-8'))
+                    compressed_bytes += len(data)
+                    converted += 1
+                    if not dry_run:
+                        Alignment.objects.using(write_db).filter(pk=alignment.pk).update(threaded_template=CompressedText(data))
+            last_pk = batch[-1].pk
+            if options['verbosity'] > 1:
+                self.stdout.write("Processed up to pk %s" % last_pk)
+
+        ratio = float(raw_bytes) / compressed_bytes if compressed_bytes else 0
+        self.stdout.write(
+            "%s %d threaded templates (%d already compressed, %d left as plain text): "
+            "%d -> %d bytes, ratio %.1fx" % (
+                "Would compress" if dry_run else "Compressed",
+                converted, skipped, incompressible, raw_bytes, compressed_bytes, ratio)
+        )
@@ -0,0 +1,139 @@
+import logging
+
+from django.db import models, transaction
+
+from .routers import get_primary_alias
+
+logger = logging.getLogger('dj_bioinformatics_protein.' + __name__)
+
+
+class RoutedQuerySet(models.QuerySet):
+    """ Explicit routing hints on top of PrimaryReplicaRouter.
+    """
+
+    def primary(self):
+        """ Read from the primary, e.g. right after another process wrote the row.
+        """
+        return self.using(get_primary_alias())
+
+
+class FASTAQuerySet(RoutedQuerySet):
+
+    def get_by_hash(self, sha256):
+        """ Look a FASTA up by sequence hash. A miss on a replica is retried on
+        the primary before raising DoesNotExist, since the row may simply not
+        have replicated yet.
+        """
+        try:
+            return self.get(sha256=sha256)
+        except self.model.DoesNotExist:
+            if self.db == get_primary_alias():
+                raise
+            return self.primary().get(sha256=sha256)
+
+
+class AlignmentQuerySet(RoutedQuerySet):
+    """ Presets that keep the large sequence/model columns of Alignment out of
+    the SELECT unless the caller actually needs them. Accessing a column that
+    was left out triggers a refetch per row (see Alignment.refresh_from_db).
+    """
+
+    SUMMARY_FIELDS = [
+        'id',
+        'alignment_method',
+        'rank',
+        'active',
+        'target_pdb_code',
+        'target_pdb_chain',
+        'p_correct',
+    ]
+
+    def summary(self):
+        """ Only the columns shown on list pages: rank, method, PDB code/chain
+        and p_correct.
+        """
+        return self.only(*self.SUMMARY_FIELDS)
+
+    def for_grishin(self):
+        """ Everything needed to render grishin_lines / target_grishin_tag.
+        """
+        return self.defer(
+            'full_query_sequence',
+            'modified_query_aln_seq',
+            'modified_target_aln_seq',
+            'threaded_template',
+            'residue_map',
+        )
+
+    def for_threading(self):
+        """ Aligned sequences, offsets and the threaded model, without the
+        full query sequence.
+        """
+        return self.defer('full_query_sequence')
+
+    def build_residue_maps(self, batch_size=500):
+        """ (Re)compute and store residue_map for every alignment in this
+        queryset, batch_size rows per transaction. Rows are read from this
+        queryset's database and the maps always written to the primary.
+        Returns the number of rows written; alignments whose aligned sequences
+        don't line up are logged and skipped.
+        """
+        fields = ['pk'] + sorted(self.model.RESIDUE_MAP_SOURCE_FIELDS)
+        write_db = get_primary_alias()
+        written = 0
+        last_pk = None
+        while True:
+            batch = self.order_by('pk').only(*fields)
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            batch = list(batch[:batch_size])
+            if not batch:
+                return written
+            with transaction.atomic(using=write_db):
+                for alignment in batch:
+                    try:
+                        residue_map = alignment.build_residue_map()
+                    except ValueError as e:
+                        logger.warning("Not storing a residue map for alignment %s: %s" % (alignment.pk, e))
+                        continue
+                    self.model.objects.using(write_db).filter(pk=alignment.pk).update(residue_map=residue_map)
+                    written += 1
+            last_pk = batch[-1].pk
+
+    def _map_position(self, position, direction):
+        rows = {}
+        missing = []
+        for pk, residue_map, query_start, target_start in self.values_list(
+                'pk', 'residue_map', 'query_start', 'target_start'):
+            if residue_map is None or not residue_map.starts_at(query_start, target_start):
+                missing.append(pk)
+                residue_map = None
+            rows[pk] = residue_map
+        if missing:
+            # rows without a (current) stored map; one extra query for all of them
+            for alignment in self.model.objects.using(self.db).filter(pk__in=missing).only(
+                    *self.model.RESIDUE_MAP_SOURCE_FIELDS):
+                try:
+                    rows[alignment.pk] = alignment.build_residue_map()
+                except ValueError:
+                    pass
+        return {
+            pk: getattr(residue_map, direction)(position) if residue_map is not None else None
+            for pk, residue_map in rows.items()
+        }
+
+    def map_query_position(self, i):
+        """ {alignment pk: template residue aligned to query residue i, or None}
+        for every alignment in the queryset, e.g.
+        Alignment.objects.filter(full_query_sequence=sequence).map_query_position(42)
+        """
+        return self._map_position(i, 'query_to_target')
+
+    def map_target_position(self, j):
+        """ {alignment pk: query residue aligned to template residue j, or None}
+        """
+        return self._map_position(j, 'target_to_query')
+
+
+FASTAManager = models.Manager.from_queryset(FASTAQuerySet)
+AlignmentManager = models.Manager.from_queryset(AlignmentQuerySet)
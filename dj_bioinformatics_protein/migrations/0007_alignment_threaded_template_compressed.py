@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import dj_bioinformatics_protein.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ Changes the column type only; existing rows keep their plain text bytes
+    (read back transparently) until `manage.py compress_threaded_templates`
+    rewrites them.
+    """
+
+    dependencies = [
+        ('dj_bioinformatics_protein', '0002_auto_20170707_0908'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='alignment',
+            name='threaded_template',
+            field=dj_bioinformatics_protein.fields.CompressedTextField(blank=True, null=True),
+        ),
+    ]
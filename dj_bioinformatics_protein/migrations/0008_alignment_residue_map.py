@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import dj_bioinformatics_protein.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """ Existing rows get their map on next save; to fill them in up front run
+    Alignment.objects.filter(residue_map=None).build_residue_maps()
+    """
+
+    dependencies = [
+        ('dj_bioinformatics_protein', '0007_alignment_threaded_template_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alignment',
+            name='residue_map',
+            field=dj_bioinformatics_protein.fields.ResidueMapField(null=True),
+        ),
+    ]
@@ -1,29 +1,22 @@
+import copy
 import logging
 import hashlib
 import os
 import re
+import warnings
 
 from django.db import models
-from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 
-from .fields import AminoAcidSequenceField, AminoAcidSequenceTextField, AminoAcidAlignmentField, AminoAcidAlignmentTextField
+from .conf import conf
+from .fields import AminoAcidSequenceField, AminoAcidSequenceTextField, AminoAcidAlignmentField, AminoAcidAlignmentTextField, \
+    CompressedTextField, ResidueMapField
+from .managers import AlignmentManager, FASTAManager
+from .residue_map import ResidueMap
+from .routers import pin_after_write
 
 logger = logging.getLogger('dj_bioinformatics_protein.' + __name__)
 
-FORMATS_SETTINGS = {
-    "MAX_DESCRIPTION_LENGTH": 1000,
-    "MAX_SEQUENCE_LENGTH": 5000,
-    "ALIGNMENT": {
-        'PDB_CODE_LENGTH': 4,
-        'PDB_CHAIN_LENGTH': 1,
-    }
-}
-
-try:
-    FORMATS_SETTINGS.update(settings.FORMATS)
-except AttributeError:
-    pass
-
 
 class FASTA(models.Model):
     """ To the client, this is usually represented with the __str__ method; the entire
@@ -41,12 +34,14 @@ class FASTA(models.Model):
     sha256 = models.CharField(unique=True, editable=False, blank=True, max_length=255)
 
     # FASTA body fields
-    description = models.CharField(max_length=FORMATS_SETTINGS['MAX_DESCRIPTION_LENGTH'])
+    description = models.CharField(max_length=conf.MAX_DESCRIPTION_LENGTH)
     comments = models.TextField(null=True)
     sequence = AminoAcidSequenceField(
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH']
+        max_length=conf.MAX_SEQUENCE_LENGTH
     )
 
+    objects = FASTAManager()
+
     def header(self, allow_comments=False):
         """ Generate the header string
         :param allow_comments: Choose to allow comments to be printed in the output
@@ -135,44 +130,33 @@ class FASTA(models.Model):
     def __str__(self):
         return str(self.formatted)
 
-try:
-    """ Maximum FASTA length is limited to the sum of all field limits by
-    default, but this may be overridden by adding the following setting in
-    settings.py:
 
-    FORMATS = {
-        'FASTA': {
-            'MAX_FASTA_FILE_LENGTH': <integer>
-        }
-    }
+def __getattr__(name):
+    """ MAX_FASTA_FILE_LENGTH and FORMATS_SETTINGS used to be computed at import;
+    they are now read from conf when asked for, so settings overrides apply.
+    Callers get a copy, as they could mutate the old module-level dict freely.
+    """
+    if name == 'MAX_FASTA_FILE_LENGTH':
+        return conf.MAX_FASTA_FILE_LENGTH
+    if name == 'FORMATS_SETTINGS':
+        return copy.deepcopy(conf.as_dict())
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-    It's also possible to override the length of a single field (which will
-    affect the total length automatically) by providing that field instead:
 
-    FORMATS = {
-        'FASTA': {
-            'MAX_DESCRIPTION_LENGTH': 255,
-            'MAX_COMMENTS_LENGTH': 2000,
-            'MAX_SEQUENCE_LENGTH': 5000,
-        }
-    }
+class DeferredFieldAccessError(Exception):
+    pass
+
 
+class _DeprecatedAlignmentSettings(object):
+    """ Alignment.ALIGNMENT_SETTINGS used to be a snapshot of
+    FORMATS['ALIGNMENT'] taken at import; it now reads conf.ALIGNMENT.
     """
-    MAX_FASTA_FILE_LENGTH = settings.FORMATS['MAX_SEQUENCE_LENGTH']
-except (AttributeError, IndexError, KeyError):
-    """ Failing to get FASTA length from settings, we can infer the maximum
-    FASTA length we should accept by summing the max_length of all the fields
-    of the FASTA object. This is an imperfect solution, since we could
-    potentially have a single field that is too long, but we assume we've
-    chosen sane limits on our side. We also assume that the client app does
-    some checking before sending data and is able to handle 4XX & 5XX errors in
-    a sane way, notifying the end user. """
-    MAX_FASTA_FILE_LENGTH = FASTA._meta.get_field('description').max_length
-    try:
-        MAX_FASTA_FILE_LENGTH += FASTA._meta.get_field('comments').max_length
-    except TypeError:
-        pass
-    MAX_FASTA_FILE_LENGTH += FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH']
+
+    def __get__(self, instance, owner):
+        warnings.warn("Alignment.ALIGNMENT_SETTINGS is deprecated; use "
+                      "dj_bioinformatics_protein.conf.conf.ALIGNMENT instead.",
+                      DeprecationWarning, stacklevel=2)
+        return copy.deepcopy(conf.ALIGNMENT)
 
 
 class Alignment(models.Model):
@@ -195,7 +179,27 @@ class Alignment(models.Model):
         "threaded_template"
     ]
 
-    ALIGNMENT_SETTINGS = FORMATS_SETTINGS['ALIGNMENT']
+    # Large text columns; list views should leave these out of the SELECT
+    # with Alignment.objects.summary() / for_grishin() / for_threading().
+    HEAVY_FIELDS = [
+        "full_query_sequence",
+        "query_aln_seq",
+        "modified_query_aln_seq",
+        "target_aln_seq",
+        "modified_target_aln_seq",
+        "threaded_template",
+        "residue_map",
+    ]
+
+    # residue_map is derived from these
+    RESIDUE_MAP_SOURCE_FIELDS = {
+        "query_aln_seq",
+        "target_aln_seq",
+        "query_start",
+        "target_start",
+    }
+
+    ALIGNMENT_SETTINGS = _DeprecatedAlignmentSettings()
 
     ALIGN_METHOD_CHOICES = [
         ('H', 'hhsearch'),
@@ -206,10 +210,10 @@ class Alignment(models.Model):
     user_template = False  # search for pdb database or user defined files
 
     full_query_sequence = AminoAcidSequenceField(
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH']
+        max_length=conf.MAX_SEQUENCE_LENGTH
     )
     query_aln_seq = AminoAcidAlignmentTextField(  #disk
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH']
+        max_length=conf.MAX_SEQUENCE_LENGTH
     )
     alignment_method = models.CharField(max_length=1, choices=ALIGN_METHOD_CHOICES)
     rank = models.IntegerField()
@@ -217,27 +221,103 @@ class Alignment(models.Model):
 
     # modeled sequence information
     query_start = models.IntegerField()  # 1 based
-    query_description = models.CharField(max_length=FORMATS_SETTINGS['MAX_DESCRIPTION_LENGTH'], null=True)
+    query_description = models.CharField(max_length=conf.MAX_DESCRIPTION_LENGTH, null=True)
     modified_query_aln_seq = AminoAcidAlignmentTextField(
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH'],
+        max_length=conf.MAX_SEQUENCE_LENGTH,
         null=True
     )
 
     # template information
     target_start = models.IntegerField()  # 1 based
-    target_description = models.TextField(max_length=FORMATS_SETTINGS['MAX_DESCRIPTION_LENGTH'], null=True)
-    target_pdb_code = models.CharField(max_length=ALIGNMENT_SETTINGS['PDB_CODE_LENGTH'])
-    target_pdb_chain = models.CharField(max_length=ALIGNMENT_SETTINGS['PDB_CHAIN_LENGTH'])
+    target_description = models.TextField(max_length=conf.MAX_DESCRIPTION_LENGTH, null=True)
+    target_pdb_code = models.CharField(max_length=conf.ALIGNMENT['PDB_CODE_LENGTH'])
+    target_pdb_chain = models.CharField(max_length=conf.ALIGNMENT['PDB_CHAIN_LENGTH'])
     target_aln_seq = AminoAcidAlignmentTextField(
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH'])
+        max_length=conf.MAX_SEQUENCE_LENGTH)
     modified_target_aln_seq = AminoAcidAlignmentTextField(
-        max_length=FORMATS_SETTINGS['MAX_SEQUENCE_LENGTH'],
+        max_length=conf.MAX_SEQUENCE_LENGTH,
         null=True
     )
 
     p_correct = models.FloatField()  # current using Robetta p_correct calculator. to be improved using alignment score
 
-    threaded_template = models.TextField(blank=True, null=True)
+    # PDB-format threaded model; stored compressed, see
+    # `manage.py compress_threaded_templates` for rows still stored as plain text
+    threaded_template = CompressedTextField(blank=True, null=True)
+
+    # query <-> target residue numbers, rebuilt on save
+    residue_map = ResidueMapField(null=True)
+
+    objects = AlignmentManager()
+
+    def build_residue_map(self):
+        return ResidueMap.from_alignment(self.query_aln_seq, self.target_aln_seq,
+                                         self.query_start, self.target_start)
+
+    def get_residue_map(self):
+        """ The stored residue map, or one built on the fly for rows saved
+        before residue maps existed or whose offsets were changed by update().
+        """
+        residue_map = self.residue_map
+        if residue_map is None or not residue_map.starts_at(self.query_start, self.target_start):
+            return self.build_residue_map()
+        return residue_map
+
+    def query_to_target(self, i):
+        """ Template residue number aligned to query residue i (1 based), or None
+        """
+        return self.get_residue_map().query_to_target(i)
+
+    def target_to_query(self, j):
+        """ Query residue number aligned to template residue j (1 based), or None
+        """
+        return self.get_residue_map().target_to_query(j)
+
+    def map_query_range(self, start, end):
+        return self.get_residue_map().map_query_range(start, end)
+
+    def map_target_range(self, start, end):
+        return self.get_residue_map().map_target_range(start, end)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            rebuild = not self.RESIDUE_MAP_SOURCE_FIELDS & self.get_deferred_fields()
+        else:
+            rebuild = bool(self.RESIDUE_MAP_SOURCE_FIELDS & set(update_fields))
+        if rebuild:
+            try:
+                self.residue_map = self.build_residue_map()
+            except ValueError as e:
+                logger.warning("Not storing a residue map for alignment %s: %s" % (self.pk, e))
+                self.residue_map = None
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'residue_map'}
+        super(Alignment, self).save(*args, **kwargs)
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        """ Django loads a deferred field by calling this with just that field,
+        once per instance. Doing so for a heavy column while iterating over a
+        queryset is an N+1; report it according to
+        FORMATS['ALIGNMENT']['DEFERRED_FIELD_ACCESS'].
+        """
+        if fields:
+            heavy = set(fields) & set(self.HEAVY_FIELDS) & self.get_deferred_fields()
+            if heavy:
+                mode = conf.ALIGNMENT.get('DEFERRED_FIELD_ACCESS')
+                message = ("Deferred field(s) %s of Alignment %s loaded with a per-row query; "
+                           "select them up front instead." % (', '.join(sorted(heavy)), self.pk))
+                if mode == 'raise':
+                    raise DeferredFieldAccessError(message)
+                elif mode == 'warn':
+                    logger.warning(message)
+        super(Alignment, self).refresh_from_db(using=using, fields=fields, **kwargs)
+
+    def iter_threaded_template(self, chunk_size=64 * 1024):
+        """ Stream the threaded template for export, decompressing as we go
+        rather than materializing the whole model.
+        """
+        return self._meta.get_field('threaded_template').iter_text(self, chunk_size)
 
     @property
     def target_grishin_tag(self):
@@ -292,7 +372,7 @@ class Alignment(models.Model):
                     else:
                         aln[attr] = "user"
                 else:
-                    aln[attr] = self.__dict__[attr]
+                    aln[attr] = getattr(self, attr)
         aln['FASTA'] = self.full_query_sequence.formatted
         aln['target_grishin_tag'] = self.target_grishin_tag
         aln['grishin_lines'] = self.grishin_lines
@@ -300,3 +380,10 @@ class Alignment(models.Model):
 
     def __str__(self):
         return self.grishin_lines
+
+
+# per model, so other apps' models keep Django's fast-path deletes
+post_save.connect(pin_after_write, sender=FASTA)
+post_delete.connect(pin_after_write, sender=FASTA)
+post_save.connect(pin_after_write, sender=Alignment)
+post_delete.connect(pin_after_write, sender=Alignment)
@@ -0,0 +1,132 @@
+import struct
+import sys
+from array import array
+
+GAP_CHARACTERS = '-.'
+
+# version, query_start, target_start, query length, target length
+_HEADER = struct.Struct('<BiiII')
+_VERSION = 1
+
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array('i', values)
+        values.byteswap()
+    return values
+
+
+class ResidueMap(object):
+    """ Bidirectional residue number mapping for one pairwise alignment.
+
+    Residue numbers are 1-based, like Alignment.query_start/target_start. The
+    map covers the aligned region of each sequence only; positions outside it,
+    or aligned to a gap, map to None.
+    """
+
+    def __init__(self, query_start, target_start, query_to_target, target_to_query):
+        self.query_start = query_start
+        self.target_start = target_start
+        # array('i'), indexed from *_start, 0 for "no partner"
+        self._query_to_target = query_to_target
+        self._target_to_query = target_to_query
+
+    @classmethod
+    def from_alignment(cls, query_aln_seq, target_aln_seq, query_start, target_start):
+        """ Build the map by walking the two aligned strings once.
+        :param query_aln_seq: aligned query, gaps as '-' (or '.')
+        :param target_aln_seq: aligned target, same length as query_aln_seq
+        :param query_start: residue number of the first query residue (1 based)
+        :param target_start: residue number of the first target residue (1 based)
+        """
+        if len(query_aln_seq) != len(target_aln_seq):
+            raise ValueError("Aligned sequences differ in length (%d != %d)" % (
+                len(query_aln_seq), len(target_aln_seq)))
+
+        query_to_target = array('i')
+        target_to_query = array('i')
+        query_residue = query_start
+        target_residue = target_start
+        for q, t in zip(query_aln_seq, target_aln_seq):
+            query_gap = q in GAP_CHARACTERS
+            target_gap = t in GAP_CHARACTERS
+            if not query_gap:
+                query_to_target.append(0 if target_gap else target_residue)
+            if not target_gap:
+                target_to_query.append(0 if query_gap else query_residue)
+            if not query_gap:
+                query_residue += 1
+            if not target_gap:
+                target_residue += 1
+        return cls(query_start, target_start, query_to_target, target_to_query)
+
+    @staticmethod
+    def _lookup(values, start, position):
+        index = position - start
+        if 0 <= index < len(values):
+            return values[index] or None
+        return None
+
+    def query_to_target(self, i):
+        """ Target residue number aligned to query residue i, or None
+        """
+        return self._lookup(self._query_to_target, self.query_start, i)
+
+    def target_to_query(self, j):
+        """ Query residue number aligned to target residue j, or None
+        """
+        return self._lookup(self._target_to_query, self.target_start, j)
+
+    def map_query_range(self, start, end):
+        """ [(i, target residue or None), ...] for query residues start..end inclusive
+        """
+        return [(i, self.query_to_target(i)) for i in range(start, end + 1)]
+
+    def map_target_range(self, start, end):
+        """ [(j, query residue or None), ...] for target residues start..end inclusive
+        """
+        return [(j, self.target_to_query(j)) for j in range(start, end + 1)]
+
+    def to_bytes(self):
+        header = _HEADER.pack(_VERSION, self.query_start, self.target_start,
+                              len(self._query_to_target), len(self._target_to_query))
+        return b''.join([
+            header,
+            _to_little_endian(self._query_to_target).tobytes(),
+            _to_little_endian(self._target_to_query).tobytes(),
+        ])
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, query_start, target_start, query_length, target_length = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError("Unsupported residue map version %d" % version)
+        offset = _HEADER.size
+        split = offset + query_length * 4
+        query_to_target = array('i')
+        query_to_target.frombytes(data[offset:split])
+        target_to_query = array('i')
+        target_to_query.frombytes(data[split:split + target_length * 4])
+        if sys.byteorder == 'big':
+            query_to_target.byteswap()
+            target_to_query.byteswap()
+        return cls(query_start, target_start, query_to_target, target_to_query)
+
+    def starts_at(self, query_start, target_start):
+        """ False if the alignment's offsets changed since this map was built,
+        e.g. through QuerySet.update(), which doesn't rebuild stored maps.
+        """
+        return self.query_start == query_start and self.target_start == target_start
+
+    def __eq__(self, other):
+        if not isinstance(other, ResidueMap):
+            return False
+        return self.to_bytes() == other.to_bytes()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<ResidueMap query %d-%d target %d-%d>' % (
+            self.query_start, self.query_start + len(self._query_to_target) - 1,
+            self.target_start, self.target_start + len(self._target_to_query) - 1)
@@ -0,0 +1,110 @@
+""" Optional primary/replica routing for this app's models. Enable with
+
+DATABASE_ROUTERS = ['dj_bioinformatics_protein.routers.PrimaryReplicaRouter']
+
+FORMATS = {
+    'DATABASES': {
+        'PRIMARY': 'default',
+        'REPLICAS': ['replica'],
+        # after a save or delete, this thread reads from the primary for this long
+        'STICKY_SECONDS': 5,
+        # also create the schema on replicas; only for setups without
+        # replication, e.g. separate local SQLite databases in tests
+        'MIGRATE_REPLICAS': False,
+    }
+}
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from .conf import conf
+
+APP_LABEL = 'dj_bioinformatics_protein'
+
+_local = threading.local()
+
+
+def get_primary_alias():
+    return conf.DATABASES['PRIMARY']
+
+
+def pin_to_primary(seconds=None):
+    """ Send this thread's reads to the primary for the next `seconds`
+    (STICKY_SECONDS by default), so we read our own writes despite replica lag.
+    """
+    if seconds is None:
+        seconds = conf.DATABASES['STICKY_SECONDS']
+    _local.pinned_until = max(getattr(_local, 'pinned_until', 0), time.time() + seconds)
+
+
+def unpin():
+    """ Forget any pin; call at request/task boundaries if threads are reused.
+    """
+    _local.pinned_until = 0
+
+
+def is_pinned():
+    return getattr(_local, 'forced', 0) > 0 or getattr(_local, 'pinned_until', 0) > time.time()
+
+
+def pin_after_write(sender, using, **kwargs):
+    """ post_save/post_delete receiver for this app's models (connected in
+    models.py). db_for_write can't pin, as Django also asks it where to read,
+    e.g. for the get() in get_or_create.
+    """
+    if using == get_primary_alias():
+        pin_to_primary()
+
+
+@contextmanager
+def use_primary():
+    """ Read from the primary inside this block regardless of pinning.
+    """
+    _local.forced = getattr(_local, 'forced', 0) + 1
+    try:
+        yield
+    finally:
+        _local.forced -= 1
+
+
+class PrimaryReplicaRouter(object):
+    """ Reads of this app's models go to a random replica, writes (including
+    get_or_create, which Django routes as a write) go to the primary. Other
+    apps are left to the next router.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # refresh_from_db, deferred fields and related lookups stay on
+            # the database the instance came from
+            return instance._state.db
+        config = conf.DATABASES
+        if not config['REPLICAS'] or is_pinned():
+            return config['PRIMARY']
+        return random.choice(config['REPLICAS'])
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        return get_primary_alias()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        config = conf.DATABASES
+        pool = set([config['PRIMARY']] + list(config['REPLICAS']))
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != APP_LABEL:
+            return None
+        config = conf.DATABASES
+        if config['MIGRATE_REPLICAS'] and db in config['REPLICAS']:
+            return True
+        # replicas get the schema through replication
+        return db == config['PRIMARY']
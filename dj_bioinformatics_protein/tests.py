@@ -1,3 +1,429 @@
-from django.test import TestCase
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, router
+from django.test import TestCase, override_settings
+
+from . import models, routers
+from .conf import conf
+from .fields import COMPRESSED_MAGIC, CODEC_LZMA, CODEC_ZLIB, CompressedText, CompressedTextField
+from .managers import AlignmentQuerySet
+from .models import FASTA, Alignment, DeferredFieldAccessError
+from .residue_map import ResidueMap
+
+PDB_TEXT = ''.join(
+    "ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00 %5.2f           C\n" % (
+        i, i, i * 1.5, -i * 0.5, i * 0.25, i % 40)
+    for i in range(1, 201)
+)
+
+
+class ConfTests(TestCase):
+
+    def test_defaults_merged_per_section(self):
+        with override_settings(FORMATS={'ALIGNMENT': {'PDB_CODE_LENGTH': 5}}):
+            self.assertEqual(conf.ALIGNMENT['PDB_CODE_LENGTH'], 5)
+            self.assertEqual(conf.ALIGNMENT['PDB_CHAIN_LENGTH'], 1)
+        self.assertEqual(conf.ALIGNMENT['PDB_CODE_LENGTH'], 4)
+
+    def test_max_fasta_file_length(self):
+        with override_settings(FORMATS={}):
+            self.assertEqual(models.MAX_FASTA_FILE_LENGTH, 6000)
+        with override_settings(FORMATS={'FASTA': {'MAX_FASTA_FILE_LENGTH': 10}}):
+            self.assertEqual(models.MAX_FASTA_FILE_LENGTH, 10)
+
+    def test_formats_settings_is_a_copy(self):
+        formats = models.FORMATS_SETTINGS
+        formats['ALIGNMENT']['PDB_CODE_LENGTH'] = 99
+        formats['MAX_SEQUENCE_LENGTH'] = 1
+        self.assertEqual(conf.ALIGNMENT['PDB_CODE_LENGTH'], 4)
+        self.assertEqual(conf.MAX_SEQUENCE_LENGTH, 5000)
+        with self.assertWarns(DeprecationWarning):
+            Alignment.ALIGNMENT_SETTINGS['PDB_CODE_LENGTH'] = 99
+        self.assertEqual(conf.ALIGNMENT['PDB_CODE_LENGTH'], 4)
+
+    def test_invalid_settings(self):
+        with override_settings(FORMATS={'ALIGNMENT': 4}):
+            with self.assertRaises(ImproperlyConfigured):
+                conf.ALIGNMENT
+
+    def test_deprecated_alignment_settings(self):
+        with override_settings(FORMATS={'ALIGNMENT': {'DEFERRED_FIELD_ACCESS': 'raise'}}):
+            with self.assertWarns(DeprecationWarning):
+                self.assertEqual(Alignment.ALIGNMENT_SETTINGS['DEFERRED_FIELD_ACCESS'], 'raise')
+
+
+def make_alignment(**kwargs):
+    fields = dict(
+        full_query_sequence='ACDEFGHIK',
+        query_aln_seq='ACD-EFGHIK',
+        target_aln_seq='AC-DEFG-IK',
+        alignment_method='H',
+        rank=1,
+        query_start=1,
+        target_start=5,
+        target_pdb_code='1ABC',
+        target_pdb_chain='A',
+        p_correct=0.5,
+        threaded_template=PDB_TEXT,
+    )
+    fields.update(kwargs)
+    return Alignment.objects.create(**fields)
+
+
+def set_raw_threaded_template(pk, value):
+    """ Write threaded_template bypassing the field, like rows stored before
+    it was compressed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE %s SET threaded_template = %%s WHERE id = %%s' % Alignment._meta.db_table,
+                       [value, pk])
+
+
+class AlignmentQuerySetTests(TestCase):
+
+    def setUp(self):
+        self.pks = [make_alignment(rank=rank).pk for rank in range(3)]
+        self.concrete = {field.attname for field in Alignment._meta.concrete_fields}
+
+    def test_deferred_fields(self):
+        summary = Alignment.objects.summary().get(pk=self.pks[0])
+        self.assertEqual(summary.get_deferred_fields(),
+                         self.concrete - set(AlignmentQuerySet.SUMMARY_FIELDS))
+        self.assertTrue(set(Alignment.HEAVY_FIELDS) <= summary.get_deferred_fields())
+
+        grishin = Alignment.objects.for_grishin().get(pk=self.pks[0])
+        self.assertEqual(grishin.get_deferred_fields(), {
+            'full_query_sequence', 'modified_query_aln_seq', 'modified_target_aln_seq',
+            'threaded_template', 'residue_map'})
+
+        threading = Alignment.objects.for_threading().get(pk=self.pks[0])
+        self.assertEqual(threading.get_deferred_fields(), {'full_query_sequence'})
+
+    def test_summary_list_is_one_query(self):
+        with self.assertNumQueries(1):
+            rows = [(a.rank, a.alignment_method, a.target_pdb_code, a.target_pdb_chain, a.p_correct, a.active)
+                    for a in Alignment.objects.summary().order_by('rank')]
+        self.assertEqual([row[0] for row in rows], [0, 1, 2])
+
+    def test_grishin_lines_without_heavy_refetch(self):
+        with self.assertNumQueries(1):
+            lines = [a.grishin_lines for a in Alignment.objects.for_grishin()]
+        self.assertEqual(len(lines), 3)
+
+    def test_deferred_access_warns(self):
+        alignment = Alignment.objects.summary().get(pk=self.pks[0])
+        with self.assertLogs('dj_bioinformatics_protein', 'WARNING') as logs:
+            self.assertEqual(alignment.threaded_template, PDB_TEXT)
+        self.assertIn('threaded_template', logs.output[0])
+
+    @override_settings(FORMATS={'ALIGNMENT': {'DEFERRED_FIELD_ACCESS': 'raise'}})
+    def test_deferred_access_raises(self):
+        alignment = Alignment.objects.summary().get(pk=self.pks[0])
+        with self.assertRaises(DeferredFieldAccessError):
+            alignment.query_aln_seq
+        # light columns are not guarded
+        self.assertEqual(Alignment.objects.summary().get(pk=self.pks[0]).query_start, 1)
+
+    @override_settings(FORMATS={'ALIGNMENT': {'DEFERRED_FIELD_ACCESS': None}})
+    def test_deferred_access_allowed(self):
+        alignment = Alignment.objects.summary().get(pk=self.pks[0])
+        with mock.patch.object(models.logger, 'warning') as warning:
+            self.assertEqual(alignment.threaded_template, PDB_TEXT)
+        warning.assert_not_called()
+
+
+class CompressedTextFieldTests(TestCase):
+
+    def setUp(self):
+        self.field = Alignment._meta.get_field('threaded_template')
+
+    def test_zlib_round_trip(self):
+        data = self.field.compress(PDB_TEXT)
+        self.assertTrue(data.startswith(COMPRESSED_MAGIC + CODEC_ZLIB))
+        self.assertLess(len(data), len(PDB_TEXT))
+        self.assertEqual(CompressedText(data).decompress(), PDB_TEXT)
+
+    def test_lzma_round_trip(self):
+        data = CompressedTextField(algorithm='lzma').compress(PDB_TEXT)
+        self.assertTrue(data.startswith(COMPRESSED_MAGIC + CODEC_LZMA))
+        self.assertEqual(CompressedText(data).decompress(), PDB_TEXT)
+
+    def test_short_values_stored_plain(self):
+        self.assertEqual(self.field.compress('END\n'), b'END\n')
+        self.assertEqual(self.field.from_db_value(b'END\n', None, None), 'END\n')
+
+    def test_legacy_values(self):
+        self.assertEqual(self.field.from_db_value('ATOM 1\n', None, None), 'ATOM 1\n')
+        self.assertEqual(self.field.from_db_value(b'ATOM 1\n', None, None), 'ATOM 1\n')
+        self.assertEqual(self.field.from_db_value(memoryview(b'ATOM 1\n'), None, None), 'ATOM 1\n')
+
+        alignment = make_alignment()
+        set_raw_threaded_template(alignment.pk, 'REMARK legacy\n')
+        self.assertEqual(Alignment.objects.get(pk=alignment.pk).threaded_template, 'REMARK legacy\n')
+
+    def test_iter_text_multibyte(self):
+        text = 'REMARK Ångström ∂α\n' * 200
+        data = self.field.compress(text)
+        for chunk_size in (1, 3, 7):
+            self.assertEqual(''.join(CompressedText(data).iter_text(chunk_size)), text)
+
+    def test_lazy_read(self):
+        alignment = make_alignment()
+        alignment = Alignment.objects.get(pk=alignment.pk)
+        self.assertIsInstance(alignment.__dict__['threaded_template'], CompressedText)
+        self.assertEqual(''.join(alignment.iter_threaded_template(chunk_size=100)), PDB_TEXT)
+        self.assertEqual(alignment.threaded_template, PDB_TEXT)
+        self.assertEqual(alignment.__dict__['threaded_template'], PDB_TEXT)
+
+    def test_unchanged_value_not_recompressed(self):
+        alignment = Alignment.objects.get(pk=make_alignment().pk)
+        stored = alignment.__dict__['threaded_template'].data
+        alignment.rank = 2
+        with mock.patch.object(CompressedTextField, 'compress') as compress:
+            alignment.save()
+        compress.assert_not_called()
+        self.assertEqual(Alignment.objects.get(pk=alignment.pk).__dict__['threaded_template'].data, stored)
+
+    def test_deferred_value_kept_on_save(self):
+        pk = make_alignment().pk
+        alignment = Alignment.objects.defer('threaded_template').get(pk=pk)
+        with self.assertLogs('dj_bioinformatics_protein', 'WARNING'):
+            alignment.save(update_fields=['threaded_template'])
+        self.assertEqual(Alignment.objects.get(pk=pk).threaded_template, PDB_TEXT)
+
+    def test_formfield(self):
+        form_class = forms.modelform_factory(Alignment, fields='__all__')
+        self.assertIn('threaded_template', form_class().fields)
+        self.assertIsInstance(form_class().fields['threaded_template'].widget, forms.Textarea)
+
+    def test_compress_command(self):
+        legacy = make_alignment()
+        set_raw_threaded_template(legacy.pk, PDB_TEXT)
+        short = make_alignment()
+        set_raw_threaded_template(short.pk, 'END\n')
+        make_alignment()  # already compressed
+
+        out = StringIO()
+        call_command('compress_threaded_templates', dry_run=True, stdout=out)
+        self.assertIn('Would compress 1 threaded templates (1 already compressed, 1 left as plain text)',
+                      out.getvalue())
+        self.assertEqual(Alignment.objects.get(pk=legacy.pk).__dict__['threaded_template'], PDB_TEXT)
+
+        out = StringIO()
+        call_command('compress_threaded_templates', batch_size=1, stdout=out)
+        self.assertIn('Compressed 1 threaded templates', out.getvalue())
+        converted = Alignment.objects.get(pk=legacy.pk)
+        self.assertIsInstance(converted.__dict__['threaded_template'], CompressedText)
+        self.assertEqual(converted.threaded_template, PDB_TEXT)
+        self.assertEqual(Alignment.objects.get(pk=short.pk).threaded_template, 'END\n')
+
+
+class ResidueMapTests(TestCase):
+
+    def test_gaps_in_either_sequence(self):
+        # query  A1 C2 D3 -  E4 F5 G6  H7 I8  K9
+        # target A5 C6 -  D7 E8 F9 G10 -  I11 K12
+        residue_map = ResidueMap.from_alignment('ACD-EFGHIK', 'AC-DEFG-IK', 1, 5)
+        self.assertEqual([residue_map.query_to_target(i) for i in range(1, 10)],
+                         [5, 6, None, 8, 9, 10, None, 11, 12])
+        self.assertEqual([residue_map.target_to_query(j) for j in range(5, 13)],
+                         [1, 2, None, 4, 5, 6, 8, 9])
+
+    def test_gap_in_both_and_offsets(self):
+        # query  A10 -  -   C11
+        # target A20 -  G21 C22
+        residue_map = ResidueMap.from_alignment('A--C', 'A.GC', 10, 20)
+        self.assertEqual(residue_map.query_to_target(10), 20)
+        self.assertEqual(residue_map.query_to_target(11), 22)
+        self.assertEqual(residue_map.target_to_query(20), 10)
+        self.assertIsNone(residue_map.target_to_query(21))
+        self.assertEqual(residue_map.target_to_query(22), 11)
+
+    def test_outside_aligned_region(self):
+        residue_map = ResidueMap.from_alignment('A--C', 'A-GC', 10, 20)
+        for i in (0, 1, 9, 12, 100):
+            self.assertIsNone(residue_map.query_to_target(i))
+        for j in (0, 19, 23):
+            self.assertIsNone(residue_map.target_to_query(j))
+        self.assertEqual(residue_map.map_query_range(9, 12), [(9, None), (10, 20), (11, 22), (12, None)])
+        self.assertEqual(residue_map.map_target_range(20, 22), [(20, 10), (21, None), (22, 11)])
+
+    def test_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            ResidueMap.from_alignment('ACD', 'AC', 1, 1)
+
+    def test_bytes_round_trip(self):
+        residue_map = ResidueMap.from_alignment('ACD-EFGHIK', 'AC-DEFG-IK', 3, 250)
+        data = residue_map.to_bytes()
+        copy = ResidueMap.from_bytes(data)
+        self.assertEqual(copy, residue_map)
+        self.assertEqual(copy.map_query_range(1, 13), residue_map.map_query_range(1, 13))
+        self.assertEqual(copy.map_target_range(249, 260), residue_map.map_target_range(249, 260))
+
+    def test_stored_on_save(self):
+        alignment = Alignment.objects.get(pk=make_alignment().pk)
+        self.assertEqual(alignment.residue_map, ResidueMap.from_alignment('ACD-EFGHIK', 'AC-DEFG-IK', 1, 5))
+        self.assertEqual(alignment.query_to_target(4), 8)
+
+        with mock.patch.object(Alignment, 'build_residue_map') as build:
+            alignment.save(update_fields=['rank'])
+        build.assert_not_called()
+
+        alignment.target_start = 7
+        alignment.save(update_fields=['target_start'])
+        self.assertEqual(Alignment.objects.get(pk=alignment.pk).query_to_target(4), 10)
+
+    def test_map_query_position(self):
+        stored = make_alignment()
+        missing = make_alignment(target_start=100)
+        other = make_alignment(full_query_sequence='MKV', query_aln_seq='MKV', target_aln_seq='MKV')
+        queryset = Alignment.objects.filter(full_query_sequence='ACDEFGHIK')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(queryset.map_query_position(4), {stored.pk: 8, missing.pk: 103})
+
+        Alignment.objects.filter(pk=missing.pk).update(residue_map=None)
+        with self.assertNumQueries(2):
+            self.assertEqual(queryset.map_query_position(4), {stored.pk: 8, missing.pk: 103})
+        self.assertEqual(queryset.map_target_position(6), {stored.pk: 2, missing.pk: None})
+        self.assertNotIn(other.pk, queryset.map_query_position(1))
+
+    def test_stale_map_after_update(self):
+        alignment = make_alignment()
+        Alignment.objects.filter(pk=alignment.pk).update(target_start=100)
+
+        self.assertEqual(Alignment.objects.get(pk=alignment.pk).query_to_target(1), 100)
+        with self.assertNumQueries(2):
+            self.assertEqual(Alignment.objects.filter(pk=alignment.pk).map_query_position(1),
+                             {alignment.pk: 100})
+
+        Alignment.objects.filter(pk=alignment.pk).build_residue_maps()
+        with self.assertNumQueries(1):
+            self.assertEqual(Alignment.objects.filter(pk=alignment.pk).map_query_position(1),
+                             {alignment.pk: 100})
+
+    def test_build_residue_maps(self):
+        good = make_alignment()
+        bad = make_alignment()
+        Alignment.objects.update(residue_map=None)
+        Alignment.objects.filter(pk=bad.pk).update(target_aln_seq='AC')
+
+        with self.assertLogs('dj_bioinformatics_protein', 'WARNING'):
+            self.assertEqual(Alignment.objects.build_residue_maps(batch_size=1), 1)
+        self.assertIsNotNone(Alignment.objects.get(pk=good.pk).residue_map)
+        self.assertIsNone(Alignment.objects.get(pk=bad.pk).residue_map)
+
+
+@skipUnless('replica' in settings.DATABASES,
+            "needs a second database alias 'replica' with its own schema, see README")
+@override_settings(FORMATS={'DATABASES': {'REPLICAS': ['replica'], 'STICKY_SECONDS': 60}})
+class PrimaryReplicaRouterTests(TestCase):
+    # the runner sets up databases even for skipped classes
+    databases = {'default', 'replica'} if 'replica' in settings.DATABASES else {'default'}
+    multi_db = True  # Django < 2.2
+
+    def setUp(self):
+        patcher = mock.patch.object(router, 'routers', [routers.PrimaryReplicaRouter()])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        routers.unpin()
+        self.addCleanup(routers.unpin)
+
+    def make_fasta(self, sha256='abc'):
+        # rows written here only exist on the primary: the "replica" lags
+        return FASTA.objects.create(description='test', sequence='ACDE', sha256=sha256)
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(FASTA.objects.all().db, 'replica')
+        self.assertEqual(Alignment.objects.summary().db, 'replica')
+
+    def test_read_after_write_sticks_to_primary(self):
+        fasta = self.make_fasta()
+        self.assertEqual(fasta._state.db, 'default')
+        self.assertEqual(FASTA.objects.all().db, 'default')
+        self.assertEqual(FASTA.objects.get(sha256='abc').pk, fasta.pk)
+
+        routers.unpin()
+        self.assertEqual(FASTA.objects.all().db, 'replica')
+        routers.pin_to_primary(seconds=0)
+        self.assertEqual(FASTA.objects.all().db, 'replica')
+
+    def test_only_writes_pin(self):
+        fasta = self.make_fasta()
+        routers.unpin()
+        # the get() of get_or_create is routed as a write but writes nothing
+        self.assertEqual(FASTA.objects.get_or_create(sha256='abc')[0].pk, fasta.pk)
+        self.assertEqual(router.db_for_write(FASTA), 'default')
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(FASTA.objects.all().db, 'replica')
+
+        fasta.delete()
+        self.assertTrue(routers.is_pinned())
+
+    def test_use_primary(self):
+        with routers.use_primary():
+            self.assertEqual(FASTA.objects.all().db, 'default')
+            with routers.use_primary():
+                pass
+            self.assertEqual(FASTA.objects.all().db, 'default')
+        self.assertEqual(FASTA.objects.all().db, 'replica')
+        self.assertEqual(FASTA.objects.primary().db, 'default')
+
+    def test_get_by_hash_falls_back_to_primary(self):
+        fasta = self.make_fasta()
+        routers.unpin()
+        self.assertFalse(FASTA.objects.filter(sha256='abc').exists())
+
+        found = FASTA.objects.get_by_hash('abc')
+        self.assertEqual(found.pk, fasta.pk)
+        self.assertEqual(found._state.db, 'default')
+        with self.assertRaises(FASTA.DoesNotExist):
+            FASTA.objects.get_by_hash('missing')
+
+    def test_instance_reloads_from_its_own_database(self):
+        pk = make_alignment().pk
+        routers.unpin()
+
+        alignment = Alignment.objects.primary().for_grishin().get(pk=pk)
+        with self.assertLogs('dj_bioinformatics_protein', 'WARNING'):
+            self.assertEqual(alignment.threaded_template, PDB_TEXT)
+        alignment.refresh_from_db()
+        self.assertEqual(alignment._state.db, 'default')
+
+    def test_save_replica_summary_instance(self):
+        primary = make_alignment()
+        copy = Alignment.objects.get(pk=primary.pk)
+        copy.save(using='replica', force_insert=True)
+        routers.unpin()
+
+        alignment = Alignment.objects.summary().get(pk=primary.pk)
+        self.assertEqual(alignment._state.db, 'replica')
+        alignment.active = False
+        with self.assertLogs('dj_bioinformatics_protein', 'WARNING'):
+            alignment.save()
+        saved = Alignment.objects.primary().get(pk=primary.pk)
+        self.assertFalse(saved.active)
+        self.assertEqual(saved.threaded_template, PDB_TEXT)
+
+    def test_build_residue_maps_writes_to_primary(self):
+        pk = make_alignment().pk
+        Alignment.objects.get(pk=pk).save(using='replica', force_insert=True)
+        Alignment.objects.using('replica').update(residue_map=None)
+        Alignment.objects.update(residue_map=None)
+
+        self.assertEqual(Alignment.objects.using('replica').build_residue_maps(), 1)
+        self.assertIsNotNone(Alignment.objects.primary().get(pk=pk).residue_map)
+        self.assertIsNone(Alignment.objects.using('replica').get(pk=pk).residue_map)
+
+    def test_migrate_replicas(self):
+        router_ = routers.PrimaryReplicaRouter()
+        self.assertTrue(router_.allow_migrate('default', 'dj_bioinformatics_protein'))
+        self.assertFalse(router_.allow_migrate('replica', 'dj_bioinformatics_protein'))
+        self.assertIsNone(router_.allow_migrate('replica', 'auth'))
+        with override_settings(FORMATS={'DATABASES': {'REPLICAS': ['replica'], 'MIGRATE_REPLICAS': True}}):
+            self.assertTrue(router_.allow_migrate('replica', 'dj_bioinformatics_protein'))
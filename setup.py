@@ -7,5 +7,7 @@ setup(name='dj_bioinformatics_protein',
       author='Peter Novotnak, Yifan Song',
       author_email='peter@cyrusbio.com, yifan@cyrusbio.com',
       license='MIT',
-      packages=['dj_bioinformatics_protein', 'dj_bioinformatics_protein.migrations'],
+      packages=['dj_bioinformatics_protein', 'dj_bioinformatics_protein.migrations',
+                'dj_bioinformatics_protein.management', 'dj_bioinformatics_protein.management.commands'],
+      python_requires='>=3.7',
       zip_safe=True)